@@ -1,17 +1,32 @@
 import streamlit as st
 import google.generativeai as genai
+import hashlib
 import io
+import json
+import os
+import pickle
+import re
+import sqlite3
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import faiss
+import numpy as np
+from google.api_core import exceptions as google_exceptions
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
 
 # --- LIBRERÍAS DE LANGCHAIN ---
-from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_google_genai import GoogleGenerativeAIEmbeddings, GoogleGenerativeAIError
+from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
-from langchain.chains.question_answering import load_qa_chain
+from langchain_community.vectorstores.utils import DistanceStrategy
 
 # --- CONFIGURACIÓN DE LA PÁGINA ---
 st.set_page_config(
@@ -29,64 +44,390 @@ try:
     genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
     SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
     creds = Credentials.from_service_account_info(st.secrets["gcp_service_account"], scopes=SCOPES)
-    drive_service = build("drive", "v3", credentials=creds)
 except Exception as e:
     st.error(f"🚨 Error al configurar las APIs: {e}")
     st.stop()
 
-# --- LÓGICA DE LA APLICACIÓN ---
+# --- RECURSOS COMPARTIDOS (una sola instancia por sesión) ---
+
+# httplib2 no es seguro para uso concurrente, así que cada hilo (los
+# workers de descarga y de listado incluidos) usa su propio cliente.
+_thread_local = threading.local()
+
+def get_drive_service():
+    if not hasattr(_thread_local, 'drive_service'):
+        _thread_local.drive_service = build("drive", "v3", credentials=creds)
+    return _thread_local.drive_service
+
+def get_docs_service():
+    if not hasattr(_thread_local, 'docs_service'):
+        _thread_local.docs_service = build("docs", "v1", credentials=creds)
+    return _thread_local.docs_service
 
 @st.cache_resource
+def get_embeddings():
+    return GoogleGenerativeAIEmbeddings(
+        model="models/embedding-001",
+        task_type="RETRIEVAL_DOCUMENT"
+    )
+
+@st.cache_resource
+def get_model():
+    return genai.GenerativeModel("gemini-1.5-flash-latest")
+
+# --- LÓGICA DE LA APLICACIÓN ---
+
+FAISS_CACHE_DIR = Path(".faiss_cache")
+
+_FOLDER_ID_RE = re.compile(r'/folders/([A-Za-z0-9_-]+)')
+
+def _parse_folder_id(url):
+    """Extrae el ID canónico de carpeta de cualquier variante de URL de Drive.
+
+    Normalizar aquí garantiza que las funciones cacheadas por folder_id
+    reciban siempre la misma clave, con o sin parámetros en la URL.
+    """
+    match = _FOLDER_ID_RE.search(url)
+    if match:
+        return match.group(1)
+    # También se acepta pegar el ID directamente.
+    return url.rstrip('/').split('/')[-1].split('?')[0]
+
+# Presupuesto aproximado de contexto para el prompt (~20k tokens ≈ 80k caracteres).
+CONTEXT_CHAR_BUDGET = 80_000
+
+# Limita la longitud de la respuesta: los tokens de salida dominan el coste.
+GENERATION_CONFIG = {"max_output_tokens": 512, "temperature": 0.2, "top_p": 0.9}
+
+PROMPT_TMPL = (
+    "Responde a la pregunta usando únicamente el siguiente contexto. "
+    "Si la respuesta no está en el contexto, dilo claramente.\n\n"
+    "--- CONTEXTO ---\n{context}\n--- FIN DEL CONTEXTO ---\n\n"
+    "PREGUNTA:\n{question}"
+)
+
+def _fit_context_budget(docs, budget=CONTEXT_CHAR_BUDGET):
+    """Recorta la lista de fragmentos recuperados para no desbordar el prompt."""
+    fitted, used = [], 0
+    for doc in docs:
+        used += len(doc.page_content)
+        if fitted and used > budget:
+            break
+        fitted.append(doc)
+    return fitted
+
+def _folder_content_hash(docs):
+    """Huella del contenido de la carpeta: cambia si algún documento cambia."""
+    fingerprint = sorted((doc['id'], doc.get('modifiedTime', '')) for doc in docs)
+    return hashlib.sha256(json.dumps(fingerprint).encode()).hexdigest()
+
+# Filtro combinado: una sola consulta por carpeta trae documentos y
+# subcarpetas, y el cliente los separa por mimeType.
+_FOLDER_QUERY_MIMETYPES = (
+    "mimeType='application/vnd.google-apps.folder' or "
+    "mimeType='application/vnd.google-apps.document' or "
+    "mimeType='text/plain' or "
+    "mimeType='text/markdown'"
+)
+
+def _list_folder(folder_id):
+    """Lista una carpeta completa (documentos y subcarpetas) en una sola
+    consulta combinada, siguiendo la paginación de Drive."""
+    drive_service = get_drive_service()
+    query = f"'{folder_id}' in parents and ({_FOLDER_QUERY_MIMETYPES})"
+    folder_docs, subfolders = [], []
+    page_token = None
+    while True:
+        results = drive_service.files().list(
+            q=query,
+            pageSize=1000,
+            fields="nextPageToken, files(id, name, mimeType, modifiedTime, size)",
+            pageToken=page_token
+        ).execute()
+        for item in results.get('files', []):
+            if item['mimeType'] == 'application/vnd.google-apps.folder':
+                subfolders.append(item['id'])
+            else:
+                folder_docs.append(item)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
+    return folder_docs, subfolders
+
+# cache_data con TTL corto: el listado aporta los modifiedTime de los que
+# dependen el hash del índice y las claves de caché de contenido, así que
+# no puede quedar congelado durante toda la vida del proceso.
+@st.cache_data(ttl=600)
 def get_all_docs_from_folder(folder_id):
     docs = []
-    query = f"'{folder_id}' in parents and (mimeType='application/vnd.google-apps.document' or mimeType='text/plain' or mimeType='text/markdown')"
+    level = [folder_id]
+    visited = {folder_id}
     try:
-        results = drive_service.files().list(q=query, fields="nextPageToken, files(id, name, mimeType)").execute()
-        docs.extend(results.get('files', []))
-        folder_query = f"'{folder_id}' in parents and mimeType='application/vnd.google-apps.folder'"
-        subfolders = drive_service.files().list(q=folder_query, fields="files(id, name)").execute()
-        for subfolder in subfolders.get('files', []):
-            docs.extend(get_all_docs_from_folder(subfolder.get('id')))
+        # BFS por niveles: todas las carpetas de un nivel se listan en
+        # paralelo, así la latencia total es profundidad x RTT en lugar de
+        # carpetas x RTT. El conjunto de visitadas corta los ciclos que los
+        # accesos directos de Drive pueden introducir en el árbol.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            while level:
+                next_level = []
+                for folder_docs, subfolders in executor.map(_list_folder, level):
+                    docs.extend(folder_docs)
+                    for subfolder_id in subfolders:
+                        if subfolder_id not in visited:
+                            visited.add(subfolder_id)
+                            next_level.append(subfolder_id)
+                level = next_level
         return docs
     except HttpError as error:
         st.error(f"Error al listar archivos: {error}")
         return []
 
-@st.cache_data(ttl=600)
-def get_doc_content(doc_object):
+# Cuota por defecto de Drive: ~900 peticiones por usuario cada 100 segundos.
+_DRIVE_QUOTA_CALLS = 900
+_DRIVE_QUOTA_WINDOW = 100.0
+_drive_call_times = deque()
+_drive_call_lock = threading.Lock()
+
+def _acquire_drive_slot():
+    """Ventana deslizante sobre las llamadas a Drive: solo duerme si de
+    verdad estamos a punto de agotar la cuota, en lugar de una pausa fija."""
+    while True:
+        with _drive_call_lock:
+            now = time.monotonic()
+            while _drive_call_times and now - _drive_call_times[0] > _DRIVE_QUOTA_WINDOW:
+                _drive_call_times.popleft()
+            if len(_drive_call_times) < _DRIVE_QUOTA_CALLS:
+                _drive_call_times.append(now)
+                return
+            wait = _DRIVE_QUOTA_WINDOW - (now - _drive_call_times[0])
+        time.sleep(max(wait, 0.05))
+
+_HEADING_PREFIXES = {
+    "TITLE": "# ",
+    "HEADING_1": "# ",
+    "HEADING_2": "## ",
+    "HEADING_3": "### ",
+    "HEADING_4": "#### ",
+}
+
+def _collect_doc_lines(elements, lines):
+    """Recorre una lista de elementos estructurales del cuerpo de un Doc.
+
+    Las celdas de tabla y los índices contienen a su vez la misma forma de
+    lista, así que el recorrido es recursivo para no perder su texto.
+    """
+    for element in elements:
+        paragraph = element.get('paragraph')
+        if paragraph:
+            text = "".join(
+                run.get('textRun', {}).get('content', '')
+                for run in paragraph.get('elements', [])
+            )
+            if text.strip():
+                style = paragraph.get('paragraphStyle', {}).get('namedStyleType', '')
+                lines.append(_HEADING_PREFIXES.get(style, '') + text.strip())
+        elif 'table' in element:
+            for row in element['table'].get('tableRows', []):
+                for cell in row.get('tableCells', []):
+                    _collect_doc_lines(cell.get('content', []), lines)
+        elif 'tableOfContents' in element:
+            _collect_doc_lines(element['tableOfContents'].get('content', []), lines)
+
+def _doc_body_to_markdown(body):
+    """Aplana el cuerpo estructurado de un Google Doc a markdown sencillo."""
+    lines = []
+    _collect_doc_lines(body.get('content', []), lines)
+    return "\n".join(lines)
+
+# modified_time no se usa dentro: forma parte de la clave de caché para que
+# editar un documento en Drive invalide su entrada automáticamente.
+@st.cache_data(ttl=24 * 3600, persist="disk", show_spinner=False)
+def get_doc_content(file_id, mime_type, modified_time, size=0):
     try:
-        file_id = doc_object['id']
-        mime_type = doc_object['mimeType']
-        
+        _acquire_drive_slot()
+        drive_service = get_drive_service()
+
         if mime_type == 'application/vnd.google-apps.document':
-            request = drive_service.files().export_media(fileId=file_id, mimeType="text/plain")
-        else:
-            request = drive_service.files().get_media(fileId=file_id)
-        
+            # La API de Docs devuelve el cuerpo estructurado directamente,
+            # sin pasar por la exportación a texto plano de Drive, y así
+            # conservamos los encabezados en el markdown resultante.
+            document = get_docs_service().documents().get(
+                documentId=file_id, fields="body(content)"
+            ).execute()
+            return _doc_body_to_markdown(document.get('body', {}))
+
+        request = drive_service.files().get_media(fileId=file_id)
+
+        if size <= 10 * 1024 * 1024:
+            # Una sola llamada HTTP: la descarga reanudable por fragmentos
+            # es un sobrecoste innecesario para archivos de texto normales.
+            return request.execute().decode('utf-8', errors='replace')
+
+        # Solo los archivos realmente grandes pasan por la descarga en
+        # fragmentos, con fragmentos de 10 MB para minimizar viajes.
         fh = io.BytesIO()
-        downloader = MediaIoBaseDownload(fh, request)
+        downloader = MediaIoBaseDownload(fh, request, chunksize=10 * 1024 * 1024)
         done = False
         while not done:
-            status, done = downloader.next_chunk()
-        return fh.getvalue().decode('utf-8')
+            _, done = downloader.next_chunk()
+        return fh.getvalue().decode('utf-8', errors='replace')
     except HttpError as error:
-        print(f"No se pudo procesar el archivo {doc_object.get('name', file_id)}: {error}")
+        print(f"No se pudo procesar el archivo {file_id}: {error}")
         return ""
 
+def _maybe_to_gpu(index):
+    """Mueve el índice a GPU solo si hay una disponible y se pide
+    explícitamente con DOCTALK_FAISS_GPU=1; los despliegues con faiss-cpu
+    o sin GPU siguen funcionando igual."""
+    if (
+        os.environ.get("DOCTALK_FAISS_GPU") == "1"
+        and hasattr(faiss, "get_num_gpus")
+        and faiss.get_num_gpus() > 0
+    ):
+        return faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, index)
+    return index
+
+def _load_cached_index(cache_dir):
+    """Carga un índice persistido, mapeado en memoria cuando es posible:
+    las páginas las respalda el SO y el arranque es casi instantáneo sin
+    cargar todo el índice en RAM."""
+    index_path = str(cache_dir / "index.faiss")
+    try:
+        index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        # No todos los tipos de índice (p. ej. HNSW) soportan mmap.
+        index = faiss.read_index(index_path)
+    if isinstance(index, faiss.IndexIVF):
+        # Repara índices cacheados antes de que el build creara el mapa
+        # directo que necesita reconstruct() en la búsqueda MMR.
+        index.make_direct_map()
+    with open(cache_dir / "docstore.pkl", "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return FAISS(
+        embedding_function=get_embeddings(),
+        index=_maybe_to_gpu(index),
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+
+def _emb_cache_conn():
+    """Conexión sqlite por hilo a la caché persistente de embeddings."""
+    if not hasattr(_thread_local, 'emb_cache'):
+        FAISS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(FAISS_CACHE_DIR / "emb_cache.db")
+        conn.execute("CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, vec BLOB)")
+        _thread_local.emb_cache = conn
+    return _thread_local.emb_cache
+
+def _embed_batch_remote(batch_texts):
+    """Embebe un lote con backoff exponencial si la API devuelve un 429.
+
+    Los reintentos son locales al lote: un lote lento no frena a los demás
+    que siguen en vuelo en el pool.
+    """
+    delay = 1.0
+    for attempt in range(5):
+        try:
+            return get_embeddings().embed_documents(batch_texts)
+        except GoogleGenerativeAIError as error:
+            # LangChain envuelve el error original; el 429 real viene como
+            # causa encadenada.
+            rate_limited = isinstance(error.__cause__, google_exceptions.ResourceExhausted)
+            if attempt == 4 or not rate_limited:
+                raise
+            time.sleep(delay)
+            delay *= 2
+
+def _embed_batch(batch_texts):
+    """Embebe un lote pasando por la caché en disco: solo los fragmentos
+    cuyo contenido cambió desde la última indexación van a la API."""
+    conn = _emb_cache_conn()
+    hashes = [hashlib.blake2b(text.encode(), digest_size=16).digest() for text in batch_texts]
+    placeholders = ",".join("?" * len(hashes))
+    rows = conn.execute(
+        f"SELECT hash, vec FROM embeddings WHERE hash IN ({placeholders})", hashes
+    ).fetchall()
+    cached = {h: np.frombuffer(v, dtype=np.float32).tolist() for h, v in rows}
+
+    vectors = [cached.get(h) for h in hashes]
+    missing = [i for i, vec in enumerate(vectors) if vec is None]
+    if missing:
+        fresh = _embed_batch_remote([batch_texts[i] for i in missing])
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (hash, vec) VALUES (?, ?)",
+            [(hashes[i], np.asarray(vec, dtype=np.float32).tobytes()) for i, vec in zip(missing, fresh)]
+        )
+        conn.commit()
+        for i, vec in zip(missing, fresh):
+            vectors[i] = vec
+    return vectors
+
 def create_vector_db(docs):
     if not docs:
         return None
-    
+
+    # Si ya existe un índice para exactamente este contenido, se reutiliza
+    # en lugar de volver a descargar y re-embeber todo.
+    content_hash = _folder_content_hash(docs)
+    cache_dir = FAISS_CACHE_DIR / content_hash
+    if (cache_dir / "index.faiss").exists() and (cache_dir / "docstore.pkl").exists():
+        st.info("♻️ Índice encontrado en caché, no hace falta reconstruirlo.")
+        return _load_cached_index(cache_dir)
+
     with st.status("Construyendo base de conocimiento...", expanded=True) as status:
+        # Barra de progreso actualizada como mucho ~100 veces: cada update
+        # es un mensaje por websocket y un repintado, así que para carpetas
+        # grandes no puede ser por documento.
+        progress = st.progress(0.0, text=f"📄 Descargando {len(docs)} documentos...")
+        update_every = max(1, len(docs) // 100)
+        contents = []
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for i, content in enumerate(executor.map(
+                lambda doc: get_doc_content(
+                    doc['id'],
+                    doc['mimeType'],
+                    doc.get('modifiedTime', ''),
+                    int(doc.get('size', 0) or 0)
+                ),
+                docs
+            ), start=1):
+                contents.append(content)
+                if i % update_every == 0 or i == len(docs):
+                    progress.progress(i / len(docs), text=f"📄 Descargando documentos... {i}/{len(docs)}")
+
+        # Solapamiento al ~10%: cada carácter solapado se embebe dos veces,
+        # así que un 20% inflaba coste, memoria y tiempo de indexación.
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1200, chunk_overlap=100)
+        # Los documentos con encabezados markdown (archivos .md y los Google
+        # Docs convertidos) se parten primero por secciones para no separar
+        # un encabezado de su contenido.
+        markdown_splitter = MarkdownHeaderTextSplitter(
+            headers_to_split_on=[("#", "h1"), ("##", "h2"), ("###", "h3")]
+        )
+        section_splitter = RecursiveCharacterTextSplitter(chunk_size=1500, chunk_overlap=150)
         all_texts_with_metadata = []
-        for i, doc in enumerate(docs):
-            status.write(f"📄 Leyendo documento {i+1}/{len(docs)}: {doc['name']}...")
-            content = get_doc_content(doc)
-            if content and content.strip():
-                text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-                chunks = text_splitter.create_documents([content], metadatas=[{"source": doc['name']}])
-                all_texts_with_metadata.extend(chunks)
-            time.sleep(0.1)
+        plain_texts, plain_metadatas = [], []
+        for doc, content in zip(docs, contents):
+            if not content or not content.strip():
+                continue
+            if doc['mimeType'] in ('application/vnd.google-apps.document', 'text/markdown'):
+                sections = markdown_splitter.split_text(content)
+                for section in sections:
+                    section.metadata = {
+                        "source": doc['name'],
+                        "section": section.metadata.get("h2", ""),
+                    }
+                all_texts_with_metadata.extend(section_splitter.split_documents(sections))
+            else:
+                plain_texts.append(content)
+                plain_metadatas.append({"source": doc['name']})
+        if plain_texts:
+            # Un único create_documents para todos los archivos de texto:
+            # el splitter itera internamente sobre la lista completa.
+            all_texts_with_metadata.extend(
+                text_splitter.create_documents(plain_texts, metadatas=plain_metadatas)
+            )
 
         if not all_texts_with_metadata:
              st.warning("No se pudo leer contenido de ningún documento o todos estaban vacíos.")
@@ -98,34 +439,123 @@ def create_vector_db(docs):
             return None
 
         status.write("🧠 Creando 'embeddings' (representaciones numéricas)...")
-        embeddings = GoogleGenerativeAIEmbeddings(
-            model="models/embedding-001",
-            task_type="RETRIEVAL_DOCUMENT"
-        )
+        embeddings = get_embeddings()
         
         status.write("💾 Construyendo el índice de búsqueda en lotes...")
-        
+
+        # Lotes de 100 fragmentos (límite de la API de embeddings de Google),
+        # enviados en paralelo en lugar de uno tras otro.
         batch_size = 100
-        vector_db = None
-        for i in range(0, len(valid_docs), batch_size):
-            batch = valid_docs[i:i+batch_size]
-            status.write(f"Procesando lote {i//batch_size + 1}...")
-            if vector_db is None:
-                vector_db = FAISS.from_documents(batch, embedding=embeddings)
-            else:
-                vector_db.add_documents(batch)
-            time.sleep(0.5)
+        texts = [doc.page_content for doc in valid_docs]
+
+        # Deduplicación: fragmentos idénticos (plantillas, pies de página,
+        # solapamiento entre documentos repetidos) se embeben una sola vez y
+        # su vector se reutiliza en cada posición del índice.
+        unique_pos = {}
+        unique_texts = []
+        positions = []
+        for text in texts:
+            text_hash = hashlib.blake2b(text.encode(), digest_size=16).digest()
+            if text_hash not in unique_pos:
+                unique_pos[text_hash] = len(unique_texts)
+                unique_texts.append(text)
+            positions.append(unique_pos[text_hash])
+
+        batches = [unique_texts[i:i + batch_size] for i in range(0, len(unique_texts), batch_size)]
+        # La matriz final se preasigna una vez (la dimensión sale del primer
+        # lote) y cada lote se escribe en su rebanada, sin lista intermedia
+        # de arrays ni vstack final.
+        xu = None
+        offset = 0
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for i, batch_vectors in enumerate(executor.map(_embed_batch, batches), start=1):
+                batch = np.asarray(batch_vectors, dtype='float32')
+                if xu is None:
+                    xu = np.empty((len(unique_texts), batch.shape[1]), dtype='float32')
+                xu[offset:offset + len(batch)] = batch
+                offset += len(batch)
+                progress.progress(i / len(batches), text=f"🧠 Embebiendo lotes... {i}/{len(batches)}")
+        faiss.normalize_L2(xu)
+        # Reexpande los vectores únicos a la posición de cada fragmento.
+        xb = np.ascontiguousarray(xu[positions])
+
+        if len(valid_docs) >= 5000:
+            # Corpus grande: índice IVF entrenado una vez (sobre los vectores
+            # únicos, para no sesgar los centroides con duplicados); cada
+            # consulta explora solo nprobe celdas. SQ8 guarda cada componente
+            # como int8: 4 veces menos memoria y menos ancho de banda por
+            # consulta, con una pérdida de recuperación de pocos puntos.
+            index = faiss.index_factory(xb.shape[1], "IVF256,SQ8", faiss.METRIC_INNER_PRODUCT)
+            index.train(xu)
+            index.add(xb)
+            index.nprobe = 16
+            # La búsqueda MMR reconstruye vectores por id (index.reconstruct),
+            # que en un índice IVF falla sin el mapa directo. Se construye
+            # antes de persistir para que quede serializado con el índice.
+            index.make_direct_map()
+        else:
+            # Corpus pequeño: búsqueda exacta. Sobre vectores normalizados el
+            # producto interno equivale a similitud coseno, y IndexFlatIP se
+            # despacha como un GEMM de BLAS por bloques — sin pérdida de
+            # recuperación y sin el coste de construir un grafo HNSW.
+            index = faiss.IndexFlatIP(xb.shape[1])
+            index.add(xb)
+
+        vector_db = FAISS(
+            embedding_function=embeddings,
+            index=index,
+            docstore=InMemoryDocstore({str(i): doc for i, doc in enumerate(valid_docs)}),
+            index_to_docstore_id={i: str(i) for i in range(len(valid_docs))},
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
+
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        faiss.write_index(vector_db.index, str(cache_dir / "index.faiss"))
+        with open(cache_dir / "docstore.pkl", "wb") as f:
+            pickle.dump((vector_db.docstore, vector_db.index_to_docstore_id), f)
+
+        # La conversión a GPU va después de persistir: en disco siempre se
+        # guarda la versión CPU, legible en cualquier despliegue.
+        vector_db.index = _maybe_to_gpu(vector_db.index)
 
         status.update(label="¡Base de conocimiento lista!", state="complete")
-    
+
     return vector_db
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def _embed_query(question):
+    """El embedding de la pregunta se cachea: repetirla (o re-ejecutar el
+    script) no vuelve a llamar a la API de embeddings."""
+    return get_embeddings().embed_query(question)
+
+def _retrieve_relevant_docs(question):
+    # MMR con k explícito: fragmentos relevantes pero diversos entre sí.
+    # La búsqueda parte del vector ya embebido, evitando la capa genérica
+    # del retriever y reutilizando el embedding entre reruns.
+    return _fit_context_budget(
+        st.session_state.vector_db.max_marginal_relevance_search_by_vector(
+            _embed_query(question), k=6, fetch_k=24, lambda_mult=0.5
+        )
+    )
+
+@st.cache_resource
+def _answer_cache():
+    """Respuestas memorizadas por (hash del índice, pregunta).
+
+    Es un dict bajo cache_resource en lugar de una función cache_data para
+    poder emitir la respuesta en streaming la primera vez y aun así
+    devolver el texto memorizado al instante en las repeticiones.
+    """
+    return {}
+
 # --- INTERFAZ DE LA APLICACIÓN ---
 st.title("📚 IA de Base de Conocimiento (Google Drive)")
 st.markdown("Proporciona una URL de una carpeta de Google Drive para crear una base de conocimiento y luego haz preguntas sobre su contenido.")
 
 if 'vector_db' not in st.session_state:
     st.session_state.vector_db = None
+if 'db_hash' not in st.session_state:
+    st.session_state.db_hash = None
 
 with st.container(border=True):
     st.subheader("1. Construir la Base de Conocimiento")
@@ -136,15 +566,16 @@ with st.container(border=True):
 
     if st.button("Indexar Carpeta", type="primary", use_container_width=True):
         if folder_url:
-            try:
-                folder_id = folder_url.split('/')[-1].split('?')[0]
+            folder_id = _parse_folder_id(folder_url)
+            if not folder_id:
+                st.error("URL de carpeta no válida.")
+            else:
                 all_docs = get_all_docs_from_folder(folder_id)
                 if all_docs:
                     st.session_state.vector_db = create_vector_db(all_docs)
+                    st.session_state.db_hash = _folder_content_hash(all_docs)
                 else:
                     st.warning("No se encontraron documentos de Google o archivos de texto (.md, .txt) en la carpeta o subcarpetas.")
-            except (IndexError, AttributeError):
-                st.error("URL de carpeta no válida.")
         else:
             st.warning("Por favor, introduce una URL de carpeta.")
 
@@ -160,23 +591,39 @@ with st.container(border=True):
 
     if st.button("Obtener Respuesta", use_container_width=True, disabled=(st.session_state.vector_db is None)):
         if question:
-            with st.spinner("🧠 Buscando en la base de conocimiento y generando respuesta..."):
-                llm = ChatGoogleGenerativeAI(model="gemini-pro", temperature=0.3, convert_system_message_to_human=True)
-                retriever = st.session_state.vector_db.as_retriever()
-                chain = load_qa_chain(llm, chain_type="stuff")
-                relevant_docs = retriever.get_relevant_documents(question)
-                
+            cache = _answer_cache()
+            cache_key = (st.session_state.db_hash, question)
+
+            if cache_key in cache:
+                answer, sources, total_tokens = cache[cache_key]
+                st.success("Respuesta:")
+                st.markdown(answer)
+            else:
+                relevant_docs = _retrieve_relevant_docs(question)
                 if not relevant_docs:
-                    st.warning("No se encontraron documentos relevantes para tu pregunta en la base de conocimiento.")
+                    answer, sources, total_tokens = None, [], None
                 else:
-                    response = chain.invoke({"input_documents": relevant_docs, "question": question})
-                    st.success("Respuesta generada:")
-                    st.markdown(response['output_text'])
-
-                    with st.expander("Ver fuentes utilizadas"):
-                        sources = sorted(list({doc.metadata['source'] for doc in relevant_docs}))
-                        for source in sources:
-                            st.write(f"- {source}")
+                    context = "\n\n".join(doc.page_content for doc in relevant_docs)
+                    prompt = PROMPT_TMPL.format(context=context, question=question)
+                    st.success("Respuesta:")
+                    stream = get_model().generate_content(
+                        prompt, stream=True, generation_config=GENERATION_CONFIG
+                    )
+                    answer = st.write_stream(chunk.text for chunk in stream)
+                    usage = getattr(stream, 'usage_metadata', None)
+                    total_tokens = usage.total_token_count if usage else None
+                    sources = sorted({doc.metadata['source'] for doc in relevant_docs})
+                    cache[cache_key] = (answer, sources, total_tokens)
+
+            if answer is None:
+                st.warning("No se encontraron documentos relevantes para tu pregunta en la base de conocimiento.")
+            else:
+                if total_tokens:
+                    st.caption(f"Tokens utilizados: {total_tokens}")
+
+                with st.expander("Ver fuentes utilizadas"):
+                    for source in sources:
+                        st.write(f"- {source}")
         else:
             st.warning("Por favor, escribe una pregunta.")
 